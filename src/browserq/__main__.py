@@ -1,14 +1,13 @@
 import asyncio
 import logging
 import os
-import string
-import random
+import secrets
 
 import click
 import uvicorn
 
 from browserq import DEFAULT_DB_PATH
-from browserq.worker import start_worker
+from browserq.worker import start_worker, start_browser_host
 
 logging.basicConfig(
     level=logging.INFO,
@@ -47,7 +46,27 @@ def server(jobs: str, db_path: str, uvicorn_args: tuple[str]):
 @click.option(
     "--name", default=None, help="Worker name (random if not provided)"
 )
-def worker(jobs: str, db_path: str, name: str | None):
+@click.option(
+    "--cdp-endpoint",
+    envvar="BROWSERQ_CDP_ENDPOINT",
+    default=None,
+    help="Connect to a shared browser (see `browser-host`) instead of "
+    "launching one.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of jobs executed at the same time.",
+)
+def worker(
+    jobs: str,
+    db_path: str,
+    name: str | None,
+    cdp_endpoint: str | None,
+    concurrency: int,
+):
     worker_name = name or f"worker_{_get_random_chars(8)}"
     try:
         asyncio.run(
@@ -55,15 +74,32 @@ def worker(jobs: str, db_path: str, name: str | None):
                 name=worker_name,
                 db_path=db_path,
                 jobs_path=jobs,
+                cdp_endpoint=cdp_endpoint,
+                concurrency=concurrency,
             )
         )
     except KeyboardInterrupt:
         logger.info(f"Worker {worker_name} shutting down")
 
 
+@cli.command("browser-host")
+@click.option(
+    "--port",
+    default=9222,
+    show_default=True,
+    help="Remote debugging port workers connect to.",
+)
+def browser_host(port: int):
+    try:
+        asyncio.run(start_browser_host(port=port))
+    except KeyboardInterrupt:
+        logger.info("Browser host shutting down")
+
+
 def _get_random_chars(length: int) -> str:
-    chars = string.ascii_letters + string.digits
-    return "".join(random.choice(chars) for _ in range(length))
+    # URL-safe base64 yields 4 characters per 3 bytes, so `length` bytes
+    # always give at least `length` characters
+    return secrets.token_urlsafe(length)[:length]
 
 
 if __name__ == "__main__":
@@ -1,34 +1,120 @@
-import json
-from datetime import datetime
-from typing import TypeAlias, Literal
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from datetime import datetime, UTC
+from pathlib import Path
+from typing import NamedTuple, TypeAlias, Literal
 
 import aiosqlite
 from pydantic import BaseModel, field_validator
+from pydantic_core import from_json, to_json
 
 from browserq import jobs
 
 AsyncConnection: TypeAlias = aiosqlite.Connection
 
-_INIT_SQL = """
-CREATE TABLE IF NOT EXISTS jobs (
+logger = logging.getLogger(__name__)
+
+_PRAGMAS_SQL = """
+PRAGMA busy_timeout = 5000;
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+PRAGMA cache_size = -64000;
+PRAGMA temp_store = MEMORY;
+PRAGMA mmap_size = 268435456;
+PRAGMA wal_autocheckpoint = 1000;
+"""
+
+_JOBS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL,
-    input TEXT NOT NULL CHECK(json_valid(input)),
+    input BLOB NOT NULL,
     status TEXT NOT NULL,
     created_at DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
     updated_at DATETIME,
     worker TEXT
 );
-CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+"""
 
-CREATE TABLE IF NOT EXISTS outputs (
+_OUTPUTS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     job_id INTEGER NOT NULL,
-    output BLOB,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
     FOREIGN KEY (job_id) REFERENCES jobs (id)
 );
+"""
+
+_INIT_SQL = (
+    _JOBS_TABLE_SQL.format(table="jobs")
+    + _OUTPUTS_TABLE_SQL.format(table="outputs")
+    + """
+DROP INDEX IF EXISTS idx_jobs_status;
+CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs(created_at)
+WHERE status = 'pending';
+
 CREATE INDEX IF NOT EXISTS idx_outputs_job_id ON outputs(job_id);
 """
+)
+
+# Statements are kept as constants: sqlite3 caches prepared statements per
+# connection keyed by their SQL text, so every call after the first one
+# reuses the compiled statement.
+_CREATE_JOB_SQL = """
+INSERT INTO jobs (name, input, status)
+VALUES (?, ?, ?)
+RETURNING id, created_at, updated_at, worker
+"""
+
+_GET_JOB_BY_ID_SQL = """
+SELECT id, name, input, status, created_at, updated_at, worker
+FROM jobs
+WHERE id = ?
+"""
+
+_GET_JOB_RESULT_SQL = """
+SELECT id, job_id, hash, size
+FROM outputs
+WHERE job_id = ?
+"""
+
+_HAS_PENDING_JOBS_SQL = """
+SELECT EXISTS (SELECT 1 FROM jobs WHERE status = ?)
+"""
+
+_CLAIM_NEXT_JOB_SQL = """
+UPDATE jobs
+SET status = ?, updated_at = ?, worker = ?
+WHERE id = (
+    SELECT id
+    FROM jobs
+    WHERE status = ?
+    ORDER BY created_at ASC
+    LIMIT 1
+)
+RETURNING id, name, input
+"""
+
+_UPDATE_JOB_STATUS_SQL = """
+UPDATE jobs
+SET status = ?, updated_at = ?
+WHERE id = ?
+"""
+
+_INSERT_OUTPUT_SQL = """
+INSERT INTO outputs (job_id, hash, size)
+VALUES (?, ?, ?)
+"""
+
+_RELEASE_JOB_SQL = """
+UPDATE jobs
+SET status = ?, updated_at = ?, worker = NULL
+WHERE id = ?
+"""
 
 
 class DBJob(BaseModel):
@@ -44,26 +130,178 @@ class DBJob(BaseModel):
 
     @field_validator("input", mode="before")
     @classmethod
-    def json_str_output(cls, v: str | dict) -> dict:
-        if isinstance(v, str):
-            return json.loads(v)
+    def json_str_output(cls, v: str | bytes | dict) -> dict:
+        if isinstance(v, (str, bytes)):
+            return from_json(v)
         return v
 
 
+class ClaimedJob(NamedTuple):
+    """A job claimed by a worker, without the overhead of building a DBJob.
+
+    `input` is kept as the raw JSON bytes stored in the database, so it's only
+    parsed by the consumer that actually needs it.
+    """
+
+    id: int
+    name: str
+    input: bytes
+
+
 class DBOutput(BaseModel):
     id: int
     job_id: int
+    hash: str
+    size: int
     output: bytes | None
 
 
+def _utcnow() -> str:
+    # Same format as strftime('%Y-%m-%d %H:%M:%f', 'now') used for created_at
+    return datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def get_outputs_dir(db_path: str) -> Path:
+    """Return the directory where outputs of jobs in `db_path` are stored."""
+    return Path(f"{db_path}-outputs")
+
+
+def _output_path(outputs_dir: Path, digest: str) -> Path:
+    return outputs_dir / digest[:2] / digest
+
+
+def _write_output(outputs_dir: Path, output: bytes) -> str:
+    # Outputs are stored outside of the database, addressed by their SHA-256,
+    # so large results don't bloat the WAL and the page cache
+    digest = hashlib.sha256(output).hexdigest()
+    path = _output_path(outputs_dir, digest)
+    if path.exists():
+        return digest
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(output)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return digest
+
+
 async def create_connection(db_path: str) -> AsyncConnection:
     conn = await aiosqlite.connect(db_path)
     conn.row_factory = aiosqlite.Row
+    await conn.executescript(_PRAGMAS_SQL)
+
+    # WAL is persistent, but switching to it fails silently e.g. when
+    # another connection holds the database open in rollback journal mode.
+    async with conn.execute("PRAGMA journal_mode") as cursor:
+        (journal_mode,) = await cursor.fetchone()
+    if journal_mode != "wal":
+        logger.warning("Database is not in WAL mode (%s)", journal_mode)
+
     return conn
 
 
-async def init_db(conn: AsyncConnection) -> None:
-    await conn.execute("PRAGMA journal_mode = WAL;")
+async def create_read_connection(db_path: str) -> AsyncConnection:
+    """Open a read-only connection for polling without taking write locks."""
+    uri = f"{Path(db_path).absolute().as_uri()}?mode=ro"
+    conn = await aiosqlite.connect(uri, uri=True)
+    conn.row_factory = aiosqlite.Row
+    await conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+async def _table_sql(conn: AsyncConnection, table: str) -> str | None:
+    async with conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table,),
+    ) as cursor:
+        result = await cursor.fetchone()
+    return result["sql"] if result else None
+
+
+async def _replace_table(
+    conn: AsyncConnection, table: str, migrated_table: str
+) -> None:
+    # SQLite can't alter column types or constraints, so tables are rebuilt
+    # and swapped. The AUTOINCREMENT counter is carried over, so ids of deleted
+    # rows are never reused.
+    await conn.execute(
+        """
+        UPDATE sqlite_sequence
+        SET seq = (SELECT seq FROM sqlite_sequence WHERE name = ?)
+        WHERE name = ?
+        """,
+        (table, migrated_table),
+    )
+    await conn.execute(f"DROP TABLE {table}")
+    await conn.execute(f"ALTER TABLE {migrated_table} RENAME TO {table}")
+
+
+async def _migrate_jobs_input(conn: AsyncConnection) -> None:
+    # Before input was stored as JSON bytes, it was TEXT with a json_valid()
+    # CHECK, which rejects BLOBs on SQLite >= 3.45
+    jobs_sql = await _table_sql(conn, "jobs")
+    if not jobs_sql or "json_valid" not in jobs_sql:
+        return
+
+    logger.info("Migrating jobs table to store input as JSON bytes")
+    await conn.execute(_JOBS_TABLE_SQL.format(table="jobs_migrated"))
+    await conn.execute(
+        """
+        INSERT INTO jobs_migrated
+            (id, name, input, status, created_at, updated_at, worker)
+        SELECT id, name, CAST(input AS BLOB), status, created_at, updated_at,
+            worker
+        FROM jobs
+        """
+    )
+    await _replace_table(conn, "jobs", "jobs_migrated")
+
+
+async def _migrate_outputs_to_files(
+    conn: AsyncConnection, outputs_dir: Path
+) -> None:
+    # Outputs used to be stored as BLOBs in the outputs table itself
+    async with conn.execute("PRAGMA table_info(outputs)") as cursor:
+        columns = {row["name"] for row in await cursor.fetchall()}
+    if "output" not in columns:
+        return
+
+    logger.info("Moving job outputs from the database to %s", outputs_dir)
+    await conn.execute(_OUTPUTS_TABLE_SQL.format(table="outputs_migrated"))
+    async with conn.execute(
+        "SELECT id, job_id, output FROM outputs"
+    ) as cursor:
+        async for row in cursor:
+            output = row["output"] or b""
+            digest = await asyncio.to_thread(
+                _write_output, outputs_dir, output
+            )
+            await conn.execute(
+                """
+                INSERT INTO outputs_migrated (id, job_id, hash, size)
+                VALUES (?, ?, ?, ?)
+                """,
+                (row["id"], row["job_id"], digest, len(output)),
+            )
+    await _replace_table(conn, "outputs", "outputs_migrated")
+
+
+async def init_db(conn: AsyncConnection, outputs_dir: Path) -> None:
+    # The write lock is taken up front, so concurrently starting processes
+    # don't migrate the same tables twice
+    await conn.execute("BEGIN IMMEDIATE")
+    try:
+        await _migrate_jobs_input(conn)
+        await _migrate_outputs_to_files(conn, outputs_dir)
+    except BaseException:
+        await conn.rollback()
+        raise
     await conn.commit()
 
     await conn.executescript(_INIT_SQL)
@@ -73,15 +311,13 @@ async def init_db(conn: AsyncConnection) -> None:
 async def create_job(
     conn: AsyncConnection,
     name: str,
-    input_json: str,
+    input_: dict,
 ) -> DBJob:
+    # Input is validated by the job model before queueing, so it's stored as
+    # JSON bytes without another validity check on the SQLite side
     async with conn.execute(
-        """
-        INSERT INTO jobs (name, input, status)
-        VALUES (?, ?, ?)
-        RETURNING id, created_at, updated_at, worker
-        """,
-        (name, input_json, jobs.JobStatus.PENDING),
+        _CREATE_JOB_SQL,
+        (name, to_json(input_), jobs.JobStatus.PENDING),
     ) as cursor:
         result = await cursor.fetchone()
 
@@ -89,7 +325,7 @@ async def create_job(
 
     return DBJob(
         name=name,
-        input=input_json,
+        input=input_,
         status=jobs.JobStatus.PENDING,
         **result,
     )
@@ -99,14 +335,7 @@ async def get_job_by_id(
     conn: AsyncConnection,
     id_: int,
 ) -> DBJob | None:
-    async with conn.execute(
-        """
-        SELECT id, name, input, status, created_at, updated_at, worker
-        FROM jobs
-        WHERE id = ?
-        """,
-        (id_,),
-    ) as cursor:
+    async with conn.execute(_GET_JOB_BY_ID_SQL, (id_,)) as cursor:
         result = await cursor.fetchone()
 
     return DBJob(**result) if result else None
@@ -114,80 +343,114 @@ async def get_job_by_id(
 
 async def get_job_result_by_job_id(
     conn: AsyncConnection,
+    outputs_dir: Path,
     job_id: int,
 ) -> DBOutput | None:
-    async with conn.execute(
-        """
-        SELECT id, job_id, output
-        FROM outputs
-        WHERE job_id = ?
-        """,
-        (job_id,),
-    ) as cursor:
+    async with conn.execute(_GET_JOB_RESULT_SQL, (job_id,)) as cursor:
         result = await cursor.fetchone()
 
-    return DBOutput(**result) if result else None
+    if not result:
+        return None
 
+    path = _output_path(outputs_dir, result["hash"])
+    try:
+        output = await asyncio.to_thread(path.read_bytes)
+    except FileNotFoundError:
+        logger.warning("Output of job %d is missing: %s", job_id, path)
+        return None
+
+    return DBOutput(output=output, **result)
 
-async def get_next_job(conn: AsyncConnection, worker: str) -> DBJob | None:
-    # Acquires a reserved lock, blocking other write transactions
-    await conn.execute("BEGIN IMMEDIATE")
 
+async def has_pending_jobs(conn: AsyncConnection) -> bool:
     async with conn.execute(
-        f"""
-        SELECT id, name, input, status, created_at, updated_at, worker
-        FROM jobs
-        WHERE status = '{jobs.JobStatus.PENDING.value}'
-        ORDER BY created_at ASC
-        LIMIT 1
-        """
+        _HAS_PENDING_JOBS_SQL, (jobs.JobStatus.PENDING,)
     ) as cursor:
-        result = await cursor.fetchone()
+        (result,) = await cursor.fetchone()
 
-    if not result:
-        # Releases the lock
-        await conn.rollback()
-        return None
+    return bool(result)
 
-    db_job = DBJob(**result)
 
-    await conn.execute(
-        f"""
-        UPDATE jobs
-        SET status = '{jobs.JobStatus.IN_PROGRESS.value}', updated_at = DATETIME('now'), worker = ?
-        WHERE id = ?
-        """,
-        (worker, db_job.id),
-    )
-    await conn.commit()
-    db_job.status = jobs.JobStatus.IN_PROGRESS
-    db_job.worker = worker
+async def get_next_job(
+    conn: AsyncConnection,
+    worker: str,
+) -> ClaimedJob | None:
+    # Claims the oldest pending job in a single statement, so the write lock
+    # is only held for the duration of this UPDATE
+    try:
+        async with conn.execute(
+            _CLAIM_NEXT_JOB_SQL,
+            (
+                jobs.JobStatus.IN_PROGRESS,
+                _utcnow(),
+                worker,
+                jobs.JobStatus.PENDING,
+            ),
+        ) as cursor:
+            result = await cursor.fetchone()
+
+        await conn.commit()
+    except BaseException:
+        # The UPDATE still runs if the claim is cancelled, so it mustn't be
+        # left open for the next commit on this connection
+        await conn.rollback()
+        raise
 
-    return db_job
+    if not result:
+        return None
+
+    return ClaimedJob(result["id"], result["name"], result["input"])
 
 
 async def update_job_status(
     conn: AsyncConnection,
+    outputs_dir: Path,
     job_id: int,
     status: Literal[jobs.JobStatus.DONE, jobs.JobStatus.FAILED],
     output: bytes | None,
 ) -> None:
-    await conn.execute(
-        """
-        UPDATE jobs
-        SET status = ?, updated_at = DATETIME('now')
-        WHERE id = ?
-        """,
-        (status, job_id),
-    )
-
+    digest = None
     if output:
-        await conn.execute(
-            """
-            INSERT INTO outputs (job_id, output)
-            VALUES (?, ?)
-            """,
-            (job_id, output),
+        digest = await asyncio.to_thread(
+            _write_output, outputs_dir, output
         )
 
+    # Both statements run in the transaction implicitly opened by the UPDATE,
+    # so status and output are committed together with a single commit
+    try:
+        await conn.execute(_UPDATE_JOB_STATUS_SQL, (status, _utcnow(), job_id))
+
+        if digest:
+            await conn.execute(
+                _INSERT_OUTPUT_SQL, (job_id, digest, len(output))
+            )
+    except BaseException:
+        await conn.rollback()
+        raise
+
+    await conn.commit()
+
+
+async def release_job(conn: AsyncConnection, job_id: int) -> None:
+    """Return a claimed, but not started, job to the queue."""
+    await conn.execute(
+        _RELEASE_JOB_SQL, (jobs.JobStatus.PENDING, _utcnow(), job_id)
+    )
     await conn.commit()
+
+
+async def checkpoint_wal(
+    conn: AsyncConnection,
+    truncate: bool = False,
+) -> None:
+    """Copy WAL content into the database, optionally truncating the WAL file.
+
+    A passive checkpoint doesn't wait for readers or writers. TRUNCATE waits
+    for them (up to busy_timeout) and resets the WAL file to zero bytes.
+    """
+    mode = "TRUNCATE" if truncate else "PASSIVE"
+    async with conn.execute(f"PRAGMA wal_checkpoint({mode})") as cursor:
+        busy, _, _ = await cursor.fetchone()
+
+    if busy:
+        logger.debug("WAL checkpoint (%s) could not complete", mode)
@@ -1,4 +1,7 @@
+import hashlib
+import json
 import logging
+import os
 from abc import ABC, abstractmethod
 from enum import Enum
 from typing import ClassVar
@@ -17,12 +20,28 @@ class JobStatus(str, Enum):
     FAILED = "failed"
 
 
-def collect_jobs_defs(path: str | Path) -> dict:
+def _jobs_cache_path(path: Path) -> Path:
+    cache_dir = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    key = hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:16]
+    return cache_dir / "browserq" / f"jobs_defs.{key}.json"
+
+
+def _files_fingerprint(files: list[Path]) -> dict[str, list[int]]:
+    fingerprint = {}
+    for file_path in files:
+        stat = file_path.stat()
+        fingerprint[str(file_path)] = [stat.st_mtime_ns, stat.st_size]
+    return fingerprint
+
+
+def collect_jobs_defs(path: str | Path, use_cache: bool = False) -> dict:
     """Collect job class definitions from Python files in the specified path.
 
     Args:
         path: Path to a Python file or directory containing Python files.
             If a directory is provided, all .py files will be searched recursively.
+        use_cache: Remember which files define jobs, so that as long as no .py file
+            under `path` is added, removed or modified, only those files are imported.
 
     Returns:
         A dictionary mapping job names to job classes, where each job class is a subclass
@@ -37,6 +56,7 @@ def collect_jobs_defs(path: str | Path) -> dict:
     import inspect
 
     jobs = {}
+    job_files = []
     path = Path(path) if isinstance(path, str) else path
 
     if not path.exists():
@@ -44,6 +64,22 @@ def collect_jobs_defs(path: str | Path) -> dict:
 
     logger.info("Selected jobs path: %s", str(path))
 
+    files = [path] if path.is_file() else sorted(path.rglob("*.py"))
+    fingerprint = None
+    cache_path = _jobs_cache_path(path)
+
+    if use_cache:
+        fingerprint = _files_fingerprint(files)
+        try:
+            cache = json.loads(cache_path.read_text())
+        except (OSError, ValueError):
+            cache = None
+
+        if cache and cache["files"] == fingerprint:
+            logger.debug("Using cached jobs files from %s", cache_path)
+            files = [Path(file_path) for file_path in cache["job_files"]]
+            fingerprint = None
+
     def process_file(file_path: Path) -> None:
         if not file_path.suffix == ".py":
             return
@@ -67,16 +103,25 @@ def collect_jobs_defs(path: str | Path) -> dict:
                         "Please ensure all job names are unique."
                     )
                 jobs[obj.NAME] = obj
+                if str(file_path) not in job_files:
+                    job_files.append(str(file_path))
 
-    if path.is_file():
-        process_file(path)
-    else:
-        for file_path in path.rglob("*.py"):
-            process_file(file_path)
+    for file_path in files:
+        process_file(file_path)
 
     if len(jobs) == 0:
         raise ValueError("No job classes found in the specified path")
 
+    # Only set when the cache was requested, but missing or out of date
+    if fingerprint is not None:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(
+                json.dumps({"files": fingerprint, "job_files": job_files})
+            )
+        except OSError as e:
+            logger.debug("Failed to write jobs cache: %r", e)
+
     logger.info(
         "Found %d job(s) definitions: %s",
         len(jobs),
@@ -98,6 +143,10 @@ class BaseJob(ABC, BaseModel):
     # For example: NAME = "screenshot" or NAME = "pdf_export"
     NAME: ClassVar[str]
 
+    # Jobs are run in a browser context shared with other jobs, so cookies and storage
+    # may leak between them. Set to True to run the job in a fresh context instead.
+    requires_isolated_context: ClassVar[bool] = False
+
     @abstractmethod
     async def execute(self, page: Page) -> bytes:
         """Execute the job using the provided Playwright page.
@@ -7,7 +7,7 @@ from pathlib import Path
 from fastapi import FastAPI, Depends, HTTPException, Request
 from pydantic import BaseModel, field_validator
 
-from browserq import jobs, database, DEFAULT_DB_PATH
+from browserq import jobs, database, wakeup, DEFAULT_DB_PATH
 
 
 @asynccontextmanager
@@ -16,12 +16,14 @@ async def lifespan(app: FastAPI):
     jobs_path = os.environ.get("BROWSERQ_JOBS_PATH", str(Path().absolute()))
 
     app.state.DB_PATH = db_path
-    app.state.JOBS_DEFS = jobs.collect_jobs_defs(jobs_path)
+    app.state.OUTPUTS_DIR = database.get_outputs_dir(db_path)
+    app.state.SOCKETS_DIR = wakeup.get_sockets_dir(db_path)
+    app.state.JOBS_DEFS = jobs.collect_jobs_defs(jobs_path, use_cache=True)
 
     conn = await database.create_connection(db_path)
 
     try:
-        await database.init_db(conn)
+        await database.init_db(conn, app.state.OUTPUTS_DIR)
     finally:
         await conn.close()
 
@@ -72,7 +74,11 @@ async def create_job(
     if not is_valid:
         raise HTTPException(400, "Job validation failed")
 
-    return await database.create_job(db_conn, r.name, job.model_dump_json())
+    db_job = await database.create_job(
+        db_conn, r.name, job.model_dump(mode="json")
+    )
+    wakeup.notify_workers(request.app.state.SOCKETS_DIR)
+    return db_job
 
 
 @app.get("/jobs/{job_id}", response_model=database.DBJob)
@@ -88,7 +94,9 @@ async def get_job_by_id(
 
 @app.get("/jobs/{job_id}/result", response_model=JobOutput)
 async def get_job_result_by_job_id(
-    job_id: int, db_conn: Annotated[database.AsyncConnection, Depends(get_db)]
+    request: Request,
+    job_id: int,
+    db_conn: Annotated[database.AsyncConnection, Depends(get_db)],
 ):
     job = await database.get_job_by_id(db_conn, job_id)
     if not job:
@@ -101,7 +109,9 @@ async def get_job_result_by_job_id(
     if job.status == jobs.JobStatus.FAILED:
         raise HTTPException(500, "Job failed")
 
-    job_result = await database.get_job_result_by_job_id(db_conn, job_id)
+    job_result = await database.get_job_result_by_job_id(
+        db_conn, request.app.state.OUTPUTS_DIR, job_id
+    )
     if job_result is None:
         raise HTTPException(500, "Job finished, but there's no result")
 
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import socket
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def get_sockets_dir(db_path: str) -> Path:
+    """Return the directory where workers of `db_path` listen for wakeups."""
+    return Path(f"{db_path}-workers")
+
+
+class WakeupListener:
+    """Wakes an idle worker up when a job is queued.
+
+    SQLite can't notify other processes about changes, so each worker binds
+    a Unix datagram socket in the sockets directory, which the API server
+    pings after queueing a job. Where that isn't possible, e.g. on Windows,
+    `wait` just times out and the worker falls back to polling.
+    """
+
+    def __init__(self, sockets_dir: Path, name: str) -> None:
+        # The pid keeps workers started with the same name apart
+        self._path = sockets_dir / f"{name}.{os.getpid()}.sock"
+        self._sock: socket.socket | None = None
+        self._pinged = asyncio.Event()
+
+    def start(self) -> None:
+        if not hasattr(socket, "AF_UNIX"):
+            logger.info("Unix sockets aren't supported, polling for jobs")
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._path.unlink(missing_ok=True)
+            sock.bind(str(self._path))
+        except OSError:
+            # e.g. the path is longer than Unix sockets allow
+            logger.warning(
+                f"Can't listen on {self._path}, polling for jobs",
+                exc_info=True,
+            )
+            sock.close()
+            return
+
+        sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._on_ping)
+        self._sock = sock
+
+    def close(self) -> None:
+        if self._sock is None:
+            return
+
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        self._path.unlink(missing_ok=True)
+
+    async def wait(self, timeout: float) -> None:
+        """Wait until pinged or `timeout` seconds pass.
+
+        Pings received since the last call, e.g. while checking for jobs,
+        end the wait right away, so none of them are missed.
+        """
+        try:
+            await asyncio.wait_for(self._pinged.wait(), timeout)
+        except TimeoutError:
+            pass
+        finally:
+            self._pinged.clear()
+
+    def _on_ping(self) -> None:
+        # Drains all pings, any number of them only needs a single wakeup
+        try:
+            while self._sock.recv(16):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        self._pinged.set()
+
+
+def notify_workers(sockets_dir: Path) -> None:
+    """Ping all workers listening in `sockets_dir`, without blocking."""
+    if not hasattr(socket, "AF_UNIX"):
+        return
+
+    try:
+        paths = list(sockets_dir.glob("*.sock"))
+    except OSError:
+        return
+    if not paths:
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for path in paths:
+            try:
+                sock.sendto(b"\0", str(path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a worker that was killed
+                path.unlink(missing_ok=True)
+            except OSError:
+                # e.g. the worker's buffer is full of pings it hasn't read
+                # yet, so it's already going to wake up
+                pass
@@ -3,19 +3,26 @@ import logging
 import time
 import os
 from pathlib import Path
+from typing import NamedTuple
 
 from playwright.async_api import (
     async_playwright,
     PlaywrightContextManager,
     Browser,
+    BrowserContext,
 )
-import playwright._impl._errors
 import playwright.async_api
 
-from browserq import jobs, database
+from browserq import jobs, database, wakeup
 
 _JOB_POLL_INTERVAL = 5
 _HEARTBEAT_LOG_INTERVAL = 600
+_SHUTDOWN_TIMEOUT = 10
+_WAL_CHECKPOINT_INTERVAL = 60
+_WAL_TRUNCATE_SIZE = 8 * 1024 * 1024
+_CONTEXT_RECYCLE_AFTER = int(
+    os.environ.get("BROWSERQ_CONTEXT_RECYCLE_AFTER", 100)
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,89 +31,354 @@ logging.basicConfig(
 logger = logging.getLogger("worker-main")
 
 
+class _JobResult(NamedTuple):
+    job_id: int
+    status: jobs.JobStatus
+    output: bytes | None
+
+
+class _ContextPool:
+    """Prewarmed browser contexts, each replaced after `recycle_after` jobs."""
+
+    def __init__(
+        self, browser: Browser, size: int, recycle_after: int
+    ) -> None:
+        self._browser = browser
+        self._size = size
+        self._recycle_after = recycle_after
+        self._idle: asyncio.Queue[BrowserContext] = asyncio.Queue()
+        self._uses: dict[BrowserContext, int] = {}
+
+    async def prewarm(self) -> None:
+        for _ in range(self._size):
+            await self._spawn()
+
+    async def acquire(self) -> BrowserContext:
+        return await self._idle.get()
+
+    async def release(self, ctx: BrowserContext) -> None:
+        self._uses[ctx] += 1
+        if self._uses[ctx] < self._recycle_after:
+            self._idle.put_nowait(ctx)
+            return
+
+        del self._uses[ctx]
+        await ctx.close()
+        await self._spawn()
+
+    async def _spawn(self) -> None:
+        ctx = await self._browser.new_context()
+        self._uses[ctx] = 0
+        self._idle.put_nowait(ctx)
+
+
 async def worker_loop(
     pw_ctx: PlaywrightContextManager,
     db: database.AsyncConnection,
+    db_reader: database.AsyncConnection,
+    outputs_dir: Path,
+    sockets_dir: Path,
     name: str,
     jobs_defs: dict[str, type[jobs.BaseJob]],
+    cdp_endpoint: str | None = None,
+    concurrency: int = 1,
 ) -> None:
     log = logging.getLogger(name)
     log.info("Ready to work")
-    shutdown = False
-    last_heartbeat = time.monotonic()
     browser: Browser | None = None
-    current_job_task: asyncio.Task | None = None
+
+    # The dispatcher claims jobs and a single writer stores their results, so
+    # `db` is only used by these two coroutines, one statement group at a time
+    db_lock = asyncio.Lock()
+    claimed: asyncio.Queue[database.ClaimedJob] = asyncio.Queue()
+    results: asyncio.Queue[_JobResult | None] = asyncio.Queue()
+    # A job is only claimed when an executor is free to start it
+    free_slots = asyncio.Semaphore(concurrency)
+    wakeups = wakeup.WakeupListener(sockets_dir, name)
 
     try:
-        browser = await pw_ctx.chromium.launch(headless=True)
+        wakeups.start()
+        if cdp_endpoint:
+            log.info(f"Connecting to browser at {cdp_endpoint}")
+            browser = await pw_ctx.chromium.connect_over_cdp(cdp_endpoint)
+        else:
+            browser = await pw_ctx.chromium.launch(headless=True)
 
-        while not shutdown:
-            timeref = time.monotonic()
+        ctx_pool = _ContextPool(
+            browser,
+            size=concurrency,
+            recycle_after=_CONTEXT_RECYCLE_AFTER,
+        )
+        await ctx_pool.prewarm()
 
-            try:
-                job = await database.get_next_job(db, worker=name)
-                if not job:
-                    if timeref - last_heartbeat >= _HEARTBEAT_LOG_INTERVAL:
-                        log.info("Worker is alive and polling for jobs")
-                        last_heartbeat = timeref
+        writer = asyncio.create_task(
+            _store_results(db, outputs_dir, db_lock, results, log)
+        )
+        tasks = [
+            asyncio.create_task(
+                _dispatch_jobs(
+                    db,
+                    db_reader,
+                    db_lock,
+                    wakeups,
+                    name,
+                    claimed,
+                    free_slots,
+                    log,
+                )
+            )
+        ]
+        for _ in range(concurrency):
+            tasks.append(
+                asyncio.create_task(
+                    _execute_jobs(
+                        browser,
+                        ctx_pool,
+                        jobs_defs,
+                        claimed,
+                        results,
+                        free_slots,
+                        log,
+                    )
+                )
+            )
 
-                    await asyncio.sleep(_JOB_POLL_INTERVAL)
-                    continue
+        try:
+            # Runs until cancelled, or until any task stops e.g. an executor
+            # after the browser went away
+            done, _ = await asyncio.wait(
+                [writer, *tasks], return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            log.info("Shutting down worker")
+            for task in tasks:
+                task.cancel()
+            _, pending = await asyncio.wait(tasks, timeout=_SHUTDOWN_TIMEOUT)
+            if pending:
+                log.warning(f"{len(pending)} task(s) did not stop in time")
 
-                last_heartbeat = timeref
-                log.info(f"Starting job {job.id} ({job.name!r})")
+            results.put_nowait(None)
+            try:
+                await writer
+            except Exception:
+                log.exception("Job results writer failed")
+                # Store what's left directly, e.g. jobs interrupted above,
+                # so they aren't left in progress
+                while (result := results.get_nowait()) is not None:
+                    await _store_result(db, outputs_dir, db_lock, result, log)
 
+            while not claimed.empty():
+                job = claimed.get_nowait()
+                log.info(f"Returning job {job.id} to the queue")
                 try:
-                    async with await browser.new_context() as ctx:
-                        async with await ctx.new_page() as page:
-                            current_job_task = asyncio.create_task(
-                                jobs_defs[job.name](**job.input).execute(page)
-                            )
-                            output = await current_job_task
-
-                except (asyncio.CancelledError, playwright.async_api.Error):
-                    log.error(f"Job interrupted, marking {job.id} as failed")
-                    await _cancel_task(current_job_task)
-                    job.status = jobs.JobStatus.FAILED
-                    await database.update_job_status(
-                        db, job.id, job.status, None
-                    )
-                    shutdown = True
-                    break
-
+                    await database.release_job(db, job.id)
                 except Exception:
-                    log.exception("Job execution failed")
-                    job.status = jobs.JobStatus.FAILED
+                    log.exception(f"Failed to release job {job.id}")
 
-                else:
-                    log.info(f"Job {job.id} is done")
-                    job.status = jobs.JobStatus.DONE
+        for task in done:
+            task.result()
 
-                output = output if job.status == jobs.JobStatus.DONE else None
-                await database.update_job_status(db, job.id, job.status, output)
+    finally:
+        wakeups.close()
+        if browser:
+            await _shutdown_browser(browser, log=log)
+
+
+async def _dispatch_jobs(
+    db: database.AsyncConnection,
+    db_reader: database.AsyncConnection,
+    db_lock: asyncio.Lock,
+    wakeups: wakeup.WakeupListener,
+    name: str,
+    claimed: asyncio.Queue[database.ClaimedJob],
+    free_slots: asyncio.Semaphore,
+    log: logging.Logger,
+) -> None:
+    last_heartbeat = time.monotonic()
 
+    while True:
+        await free_slots.acquire()
+        timeref = time.monotonic()
+
+        # Checking on the read-only connection first keeps idle polls from
+        # taking the write lock
+        job = None
+        if await database.has_pending_jobs(db_reader):
+            claim = asyncio.create_task(_claim_job(db, db_lock, name))
+            try:
+                job = await asyncio.shield(claim)
             except asyncio.CancelledError:
-                log.info("Shutting down worker (no jobs interrupted)")
-                shutdown = True
-                break
+                # Lets a claim that's already underway finish and hands the
+                # job over, so it's returned to the queue on shutdown
+                if job := await claim:
+                    claimed.put_nowait(job)
+                raise
 
-    finally:
-        await _cancel_task(current_job_task, log=log)
+        if job:
+            last_heartbeat = timeref
+            claimed.put_nowait(job)
+            continue
+
+        free_slots.release()
+        if timeref - last_heartbeat >= _HEARTBEAT_LOG_INTERVAL:
+            log.info("Worker is alive and polling for jobs")
+            last_heartbeat = timeref
+
+        # Jobs queued through the API wake the worker up right away, polling
+        # picks up the rest, e.g. jobs returned to the queue by other workers
+        await wakeups.wait(timeout=_JOB_POLL_INTERVAL)
 
-        if browser:
-            await _shutdown_browser(browser, log=log)
+
+async def _claim_job(
+    db: database.AsyncConnection,
+    db_lock: asyncio.Lock,
+    name: str,
+) -> database.ClaimedJob | None:
+    async with db_lock:
+        return await database.get_next_job(db, worker=name)
+
+
+async def _execute_jobs(
+    browser: Browser,
+    ctx_pool: _ContextPool,
+    jobs_defs: dict[str, type[jobs.BaseJob]],
+    claimed: asyncio.Queue[database.ClaimedJob],
+    results: asyncio.Queue[_JobResult | None],
+    free_slots: asyncio.Semaphore,
+    log: logging.Logger,
+) -> None:
+    while True:
+        job = await claimed.get()
+        log.info(f"Starting job {job.id} ({job.name!r})")
+
+        ctx: BrowserContext | None = None
+        isolated = False
+        job_task: asyncio.Task[bytes] | None = None
+        try:
+            job_def = jobs_defs[job.name]
+            # Parses and validates the raw JSON in one pass, without building
+            # an intermediate dict to unpack into __init__
+            job_instance = job_def.model_validate_json(job.input)
+
+            isolated = job_def.requires_isolated_context
+            if isolated:
+                ctx = await browser.new_context()
+            else:
+                ctx = await ctx_pool.acquire()
+
+            async with await ctx.new_page() as page:
+                job_task = asyncio.create_task(job_instance.execute(page))
+                # Unlike awaiting the task, wait doesn't pass cancellation on
+                # to it, so the executor is interrupted right away and can
+                # cancel the job with a timeout below, even if the job
+                # ignores the cancellation
+                await asyncio.wait([job_task])
+                output = job_task.result()
+
+        except asyncio.CancelledError:
+            if job_task is None:
+                # The job never started, so it's returned to the queue on
+                # shutdown
+                claimed.put_nowait(job)
+                return
+
+            log.error(f"Job interrupted, marking {job.id} as failed")
+            # Queued before awaiting, so the job isn't left in progress even
+            # if the clean up below is interrupted
+            results.put_nowait(_JobResult(job.id, jobs.JobStatus.FAILED, None))
+            await _cancel_task(job_task, log=log)
+            return
+
+        except Exception as e:
+            # Playwright errors such as navigation timeouts only fail the job,
+            # unless the browser itself went away
+            if (
+                isinstance(e, playwright.async_api.Error)
+                and not browser.is_connected()
+            ):
+                log.error(f"Browser disconnected, marking {job.id} as failed")
+                results.put_nowait(
+                    _JobResult(job.id, jobs.JobStatus.FAILED, None)
+                )
+                await _cancel_task(job_task, log=log)
+                return
+
+            log.exception("Job execution failed")
+            results.put_nowait(_JobResult(job.id, jobs.JobStatus.FAILED, None))
+
+        else:
+            log.info(f"Job {job.id} is done")
+            results.put_nowait(_JobResult(job.id, jobs.JobStatus.DONE, output))
+
+        finally:
+            # Contexts of a disconnected browser can't be closed or recycled
+            if ctx and browser.is_connected():
+                if isolated:
+                    await ctx.close()
+                else:
+                    await ctx_pool.release(ctx)
+
+        free_slots.release()
+
+
+async def _store_results(
+    db: database.AsyncConnection,
+    outputs_dir: Path,
+    db_lock: asyncio.Lock,
+    results: asyncio.Queue[_JobResult | None],
+    log: logging.Logger,
+) -> None:
+    # Runs until it receives None, so results queued during shutdown are
+    # still stored
+    while (result := await results.get()) is not None:
+        await _store_result(db, outputs_dir, db_lock, result, log)
+
+
+async def _store_result(
+    db: database.AsyncConnection,
+    outputs_dir: Path,
+    db_lock: asyncio.Lock,
+    result: _JobResult,
+    log: logging.Logger,
+) -> None:
+    try:
+        async with db_lock:
+            await database.update_job_status(
+                db, outputs_dir, result.job_id, result.status, result.output
+            )
+        return
+    except Exception:
+        log.exception(f"Failed to store result of job {result.job_id}")
+
+    if result.status == jobs.JobStatus.FAILED and result.output is None:
+        return
+
+    # Storing the output failed, but the job can still be marked as failed
+    # instead of being left in progress
+    try:
+        async with db_lock:
+            await database.update_job_status(
+                db, outputs_dir, result.job_id, jobs.JobStatus.FAILED, None
+            )
+    except Exception:
+        log.exception(f"Failed to mark job {result.job_id} as failed")
 
 
 async def _cancel_task(
-    task: asyncio.Task | None, log: logging.Logger | None = None
+    task: asyncio.Task[bytes] | None,
+    timeout: float = 2.0,
+    log: logging.Logger | None = None,
 ) -> None:
     log = log or logger
     if task and not task.done():
         task.cancel()
-        try:
-            await task
-        except Exception as e:
-            log.debug(f"Canceled task clean up error: {e!r}")
+        # Unlike wait_for, wait doesn't wait for the task to finish after the
+        # timeout, so a job ignoring cancellation can't block the shutdown
+        await asyncio.wait([task], timeout=timeout)
+        if not task.done():
+            log.warning("Canceled task did not finish in time")
+        elif not task.cancelled() and task.exception():
+            log.debug(f"Canceled task clean up error: {task.exception()!r}")
 
 
 async def _shutdown_browser(
@@ -119,18 +391,82 @@ async def _shutdown_browser(
         log.warning(f"Failed to close browser gracefully: {e!r}")
 
 
+async def _checkpoint_wal(db_path: str) -> None:
+    # Uses its own connection, as a checkpoint can't run inside a transaction
+    # that the worker's connection may have open at that moment
+    conn: database.AsyncConnection | None = None
+    wal_path = f"{db_path}-wal"
+
+    try:
+        while True:
+            await asyncio.sleep(_WAL_CHECKPOINT_INTERVAL)
+            # Errors are only logged, the next attempt may well succeed and
+            # the worker keeps running without checkpoints in the meantime
+            try:
+                if conn is None:
+                    conn = await database.create_connection(db_path)
+                wal_size = (
+                    os.path.getsize(wal_path)
+                    if os.path.exists(wal_path)
+                    else 0
+                )
+                await database.checkpoint_wal(
+                    conn, truncate=wal_size > _WAL_TRUNCATE_SIZE
+                )
+            except Exception:
+                logger.exception("WAL checkpoint failed")
+    finally:
+        if conn:
+            await conn.close()
+
+
 async def start_worker(
-    name: str, db_path: str, jobs_path: str | None = None
+    name: str,
+    db_path: str,
+    jobs_path: str | None = None,
+    cdp_endpoint: str | None = None,
+    concurrency: int = 1,
 ) -> None:
     if not os.path.exists(db_path):
         raise FileNotFoundError(db_path)
 
     jobs_path = jobs_path or Path().absolute()
-    jobs_defs = jobs.collect_jobs_defs(jobs_path)
+    jobs_defs = jobs.collect_jobs_defs(jobs_path, use_cache=True)
     conn = await database.create_connection(db_path)
+    read_conn = await database.create_read_connection(db_path)
+    checkpointer = asyncio.create_task(_checkpoint_wal(db_path))
 
     try:
         async with async_playwright() as p:
-            await worker_loop(pw_ctx=p, db=conn, name=name, jobs_defs=jobs_defs)
+            await worker_loop(
+                pw_ctx=p,
+                db=conn,
+                db_reader=read_conn,
+                outputs_dir=database.get_outputs_dir(db_path),
+                sockets_dir=wakeup.get_sockets_dir(db_path),
+                name=name,
+                jobs_defs=jobs_defs,
+                cdp_endpoint=cdp_endpoint,
+                concurrency=concurrency,
+            )
     finally:
+        checkpointer.cancel()
+        await asyncio.gather(checkpointer, return_exceptions=True)
+        await read_conn.close()
         await conn.close()
+
+
+async def start_browser_host(port: int) -> None:
+    """Run a single Chromium instance that workers can share over CDP."""
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(
+            headless=True, args=[f"--remote-debugging-port={port}"]
+        )
+        disconnected = asyncio.Event()
+        browser.on("disconnected", lambda _: disconnected.set())
+        logger.info(f"Browser is listening on http://127.0.0.1:{port}")
+
+        try:
+            await disconnected.wait()
+        finally:
+            await _shutdown_browser(browser)